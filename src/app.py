@@ -1,55 +1,99 @@
 import time
 import requests
 import os
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from elasticsearch.exceptions import RequestError
 
 from flock_server import (
-    User,
+    es,
     Setting,
     KeybaseNotification,
     create_api_app,
     start_keybase_bot,
     elasticsearch_url,
+    migrate_user_index,
 )
 
+# Concurrent connections per gunicorn worker, which is also the size of each worker's
+# elasticsearch connection pool
+GUNICORN_WORKER_CONNECTIONS = 1000
+
+
+def init_model(model):
+    try:
+        model.init()
+    except RequestError as e:
+        # The index already exists, likely created by the other container
+        if e.error != "resource_already_exists_exception":
+            raise
+
 
 if __name__ == "__main__":
-    # Wait for ElasticSearch to start
+    # Wait for ElasticSearch to start, backing off from 0.25s up to 4s between tries
     print("Waiting for ElasticSearch")
+    if "ELASTIC_CA_CERT" in os.environ:
+        ca_cert_path = os.environ["ELASTIC_CA_CERT"]
+    else:
+        ca_cert_path = None
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(max_retries=0))
+    session.mount("http://", HTTPAdapter(max_retries=0))
+    delay = 0.25
     while True:
         try:
-            if "ELASTIC_CA_CERT" in os.environ:
-                ca_cert_path = os.environ["ELASTIC_CA_CERT"]
-            else:
-                ca_cert_path = None
-
-            r = requests.get(elasticsearch_url, verify=ca_cert_path)
+            # Any response at all (even 401 if security is enabled) means it's up
+            session.head(elasticsearch_url, verify=ca_cert_path, timeout=2)
             print("{} is ready".format(elasticsearch_url))
             break
 
-        except:
+        except requests.RequestException:
             print("{} not ready, waiting ...".format(elasticsearch_url))
-            time.sleep(5)
+            time.sleep(delay)
+            delay = min(delay * 2, 4.0)
 
-    # Initialize models
-    print("Initializing user model")
-    try:
-        User.init()
-    except:
-        pass
-    try:
-        Setting.init()
-    except:
-        pass
-    try:
-        KeybaseNotification.init()
-    except:
-        pass
+    # Initialize models. The gateway owns the user index, so only it migrates it, and
+    # the keybase bot doesn't race it
+    print("Initializing models")
+    if os.environ.get("FLOCK_KEYBASE") != "1":
+        migrate_user_index()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(init_model, [Setting, KeybaseNotification]))
+
+    # osquery indices are write-heavy, so refresh them less often than the default
+    es.indices.put_template(
+        name="flock",
+        body={"index_patterns": ["flock-*"], "settings": {"refresh_interval": "30s"}},
+    )
 
     if os.environ.get("FLOCK_KEYBASE") == "1":
         # Start keybase bot
         start_keybase_bot()
 
-    else:
-        # Start web service
+    elif os.environ.get("FLASK_DEBUG") == "1":
+        # Start web service with the development server
         app = create_api_app()
         app.run(host="0.0.0.0", port=5000, debug=True)
+
+    else:
+        # Start web service with gunicorn, using gevent workers since requests spend
+        # most of their time waiting on elasticsearch
+        os.environ["ELASTICSEARCH_MAXSIZE"] = str(GUNICORN_WORKER_CONNECTIONS)
+        os.execvp(
+            "gunicorn",
+            [
+                "gunicorn",
+                "flock_server.wsgi:app",
+                "--bind",
+                "0.0.0.0:5000",
+                "--worker-class",
+                "gevent",
+                "--workers",
+                str(os.cpu_count() or 1),
+                "--worker-connections",
+                str(GUNICORN_WORKER_CONNECTIONS),
+                "--keep-alive",
+                "30",
+            ],
+        )
@@ -1,5 +1,12 @@
 # Connect to elasticsearch, define models
-from .elasticsearch import User, Setting, KeybaseNotification, elasticsearch_url
+from .elasticsearch import (
+    es,
+    User,
+    Setting,
+    KeybaseNotification,
+    elasticsearch_url,
+    migrate_user_index,
+)
 
 # API endpoint
 from .api import create_api_app
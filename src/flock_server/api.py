@@ -1,32 +1,119 @@
+import re
+import hmac
 import json
+import logging
+import hashlib
+import shutil
 import secrets
 from datetime import datetime
+from tempfile import SpooledTemporaryFile
 from functools import wraps
-from collections import defaultdict
+from itertools import chain
+from collections import defaultdict, Counter
 
-from flask import Flask, request
-from elasticsearch_dsl import Index, Search
+import ijson
+from flask import Flask, request, g
+from elasticsearch import helpers
+from elasticsearch_dsl import Search
 
+from .cache import TTLCache
 from .elasticsearch import es, User
 from .keybase_notifications import KeybaseNotifications
 
 
+# How long to remember successful and failed auth lookups, in seconds
+AUTH_CACHE_TTL = 300
+AUTH_CACHE_FAILURE_TTL = 30
+
+# How long to remember responses of read-only probes, in seconds
+PROBE_CACHE_TTL = 10
+
+# Usernames must only contain letters, numbers, '-', or '_'
+_USERNAME_RE = re.compile(r"\A[A-Za-z0-9_\-]+\Z")
+
+# Characters to strip from names
+_STRIP_TABLE = str.maketrans("", "", "`{}!@#$%^&*_")
+
+# Submissions at least this big are streamed instead of parsed all at once
+STREAMING_MIN_CONTENT_LENGTH = 64 * 1024
+
+# Streamed submissions are spooled in memory up to this size, and on disk beyond it
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+# Streamed submissions can't nest deeper than this. osquery docs are shallow
+MAX_JSON_DEPTH = 32
+
+
+class InvalidSubmission(Exception):
+    pass
+
+
+def _check_json_depth(stream):
+    """
+    Make sure JSON from a stream doesn't nest deeper than MAX_JSON_DEPTH. This uses
+    ijson's basic events, since the prefixes it builds for every other event grow with
+    the square of the nesting depth
+    """
+    depth = 0
+    for event, _ in ijson.basic_parse(stream, use_float=True):
+        if event == "start_map" or event == "start_array":
+            depth += 1
+            if depth > MAX_JSON_DEPTH:
+                raise InvalidSubmission("Invalid JSON object")
+        elif event == "end_map" or event == "end_array":
+            depth -= 1
+
+
+def _iter_json_array(stream):
+    """
+    Lazily parse a JSON array from a stream, yielding one item at a time
+    """
+    events = ijson.parse(stream, use_float=True)
+    first_event = next(events)
+    if first_event[1] != "start_array":
+        raise InvalidSubmission("Data is not an array")
+    return ijson.items(chain([first_event], events), "item")
+
+
 def create_api_app(test_config=None):
     keybase_notifications = KeybaseNotifications()
 
+    # Caches of auth lookups, keyed by (username, sha256 of token). Failures are kept
+    # apart so that a flood of bad tokens can't push out valid users
+    auth_cache = TTLCache()
+    auth_failure_cache = TTLCache()
+
+    # Cache of read-only probe responses, keyed by route
+    probe_cache = TTLCache()
+
     # Create the flask
     app = Flask(__name__)
     if test_config:
         app.config.update(test_config)
 
     def check_auth(username, token):
-        r = (
-            Search(index="user")
-            .query("match", username=username)
-            .query("match", token=token)
-            .execute()
-        )
-        return len(r) == 1
+        """
+        Returns the user if the username and token are valid, otherwise None
+        """
+        key = (username, hashlib.sha256(token.encode()).hexdigest())
+        user = auth_cache.get(key)
+        if user is not None:
+            return user
+        if auth_failure_cache.get(key):
+            return None
+
+        # Look up the user with a (cacheable) term filter, and compare tokens here in
+        # constant time
+        r = Search(using=es, index="user").filter("term", username=username).execute()
+        for hit in r:
+            if hit.username == username and hmac.compare_digest(
+                hit.token.encode(), token.encode()
+            ):
+                auth_cache.set(key, hit, AUTH_CACHE_TTL)
+                return hit
+
+        auth_failure_cache.set(key, True, AUTH_CACHE_FAILURE_TTL)
+        return None
 
     def authenticate():
         return {}, 401
@@ -35,36 +122,46 @@ def create_api_app(test_config=None):
         @wraps(f)
         def decorated(*args, **kwargs):
             auth = request.authorization
-            if not auth or not check_auth(auth.username, auth.password):
+            if not auth:
                 return authenticate()
+
+            # Remember the authenticated user for the rest of the request
+            user = check_auth(auth.username, auth.password)
+            if not user:
+                return authenticate()
+            g.user = user
+
             return f(*args, **kwargs)
 
         return decorated
 
     def api_error(error_msg):
-        headers = []
-        for header in list(request.headers):
-            if header[0].lower() != "authorization":
-                headers.append(header)
-
-        request_body = request.get_data()
-        if len(request_body) > 1024:
-            request_body = request_body[0:1024] + b" [...snip...]"
-
-        error_details = {
-            "method": request.method,
-            "path": request.path,
-            "headers": headers,
-            "body": request_body,
-            "error_msg": error_msg,
-        }
-
-        # If this is an authenticated API request, add the username
-        auth = request.authorization
-        if auth:
-            error_details["username"] = auth.username
-
-        app.logger.debug(f"API error: {error_details}")
+        # Only collect request details if they will actually be logged
+        if app.logger.isEnabledFor(logging.DEBUG):
+            headers = [
+                (key, value)
+                for key, value in request.headers.items()
+                if key.lower() != "authorization"
+            ]
+
+            request_body = request.get_data()
+            if len(request_body) > 1024:
+                request_body = request_body[0:1024] + b" [...snip...]"
+
+            error_details = {
+                "method": request.method,
+                "path": request.path,
+                "headers": headers,
+                "body": request_body,
+                "error_msg": error_msg,
+            }
+
+            # If this is an authenticated API request, add the username
+            auth = request.authorization
+            if auth:
+                error_details["username"] = auth.username
+
+            app.logger.debug(f"API error: {error_details}")
 
         return {"error": True, "error_msg": error_msg}, 400
 
@@ -74,22 +171,31 @@ def create_api_app(test_config=None):
         success_obj["error"] = False
         return success_obj, 200
 
-    def get_name():
-        results = (
-            Search(index="user")
-            .query("match", username=request.authorization["username"])
-            .execute()
-        )
-        if len(results) == 1:
-            user = results[0]
-            return user.name
-        else:
-            return None
+    def validate_osquery_doc(i, doc):
+        # Item should be an object
+        if not isinstance(doc, dict):
+            return "Item {} is not an object".format(i)
+
+        # hostIdentifier should be the username
+        if doc.get("hostIdentifier") != request.authorization["username"]:
+            return "Item {} does not contain the correct hostIdentifier".format(i)
+
+        return None
 
     @app.route("/es-test")
     def es_test():
-        r = Search(index="user").query("match", username="user1").execute()
-        return str(r.hits)
+        response = probe_cache.get(request.path)
+        if response is None:
+            # Let elasticsearch serve repeats from its shard request cache too
+            r = (
+                Search(using=es, index="user")
+                .query("match", username="user1")
+                .params(request_cache=True, preference="_local")
+                .execute()
+            )
+            response = str(r.hits)
+            probe_cache.set(request.path, response, PROBE_CACHE_TTL)
+        return response
 
     @app.route("/register", methods=["POST"])
     def register():
@@ -102,25 +208,16 @@ def create_api_app(test_config=None):
             return api_error("You must provide a username")
 
         # Validate username
-        valid_chars = (
-            "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ01234567890_-"
-        )
-        for c in username:
-            if c not in valid_chars:
-                return api_error(
-                    "Usernames must only contain letters, numbers, '-', or '_'"
-                )
+        if not _USERNAME_RE.match(username):
+            return api_error(
+                "Usernames must only contain letters, numbers, '-', or '_'"
+            )
 
         # Strip invalid characters from name
-        new_name = ""
-        invalid_chars = "`{}!@#$%^&*_"
-        for c in name:
-            if c not in invalid_chars:
-                new_name += c
-        name = new_name
+        name = name.translate(_STRIP_TABLE)
 
         # Is the user already registered?
-        r = Search(index="user").query("match", username=username).execute()
+        r = Search(using=es, index="user").filter("term", username=username).execute()
         if len(r) != 0:
             keybase_notifications.add(
                 "user_already_exists", {"username": username, "name": name},
@@ -132,10 +229,14 @@ def create_api_app(test_config=None):
                 )
             )
 
-        # Add user, and force a refresh of the index
+        # Add user, and wait until it's searchable
         user = User(username=username, name=name, token=secrets.token_hex(16))
-        user.save()
-        Index("user").refresh()
+        user.save(using=es, refresh="wait_for")
+
+        # Forget any cached auth lookups for this username
+        auth_cache.delete_matching(lambda key: key[0] == username)
+        auth_failure_cache.delete_matching(lambda key: key[0] == username)
+        probe_cache.clear()
 
         keybase_notifications.add(
             "user_registered", {"username": username, "name": name},
@@ -152,102 +253,124 @@ def create_api_app(test_config=None):
     @app.route("/submit", methods=["POST"])
     @requires_auth
     def submit():
-        try:
-            docs = request.json
-        except:
-            return api_error("Invalid JSON object")
-
-        if not docs:
-            return api_error("Invalid JSON object")
-
-        if type(docs) != list:
-            return api_error("Data is not an array")
-
-        # Validate
-        for i, doc in enumerate(docs):
-            # Item should be an object
-            if type(doc) != dict:
-                return api_error("Item {} is not an object".format(i))
-
-            # hostIdentifier should be the username
-            if ("hostIdentifier" not in doc) or (
-                request.authorization["username"] != doc["hostIdentifier"]
-            ):
-                return api_error(
-                    "Item {} does not contain the correct hostIdentifier".format(i)
-                )
-
-        # Load the user
-        results = (
-            Search(index="user")
-            .query("match", username=request.authorization["username"])
-            .execute()
-        )
-        user = results[0]
-
-        # Make a list of the types of docs that should trigger notifications
-        notification_names = []
-        for key in keybase_notifications.notifications:
-            if keybase_notifications.notifications[key]["type"] == "osquery":
-                notification_names.append(key)
-
-        # Dictionary that sorts incoming docs by notification type
-        docs_by_type = {}
+        if (request.content_length or 0) < STREAMING_MIN_CONTENT_LENGTH:
+            # Small batches are quicker to parse all at once
+            try:
+                docs = request.json
+            except:
+                return api_error("Invalid JSON object")
+
+            if not docs:
+                return api_error("Invalid JSON object")
+
+            if not isinstance(docs, list):
+                return api_error("Data is not an array")
+
+            # Validate
+            for i, doc in enumerate(docs):
+                error_msg = validate_osquery_doc(i, doc)
+                if error_msg:
+                    return api_error(error_msg)
+        else:
+            # Spool large batches to a temporary file and stream through them twice,
+            # so every doc is validated before any are indexed, without holding them
+            # all in memory
+            if not request.is_json:
+                return api_error("Invalid JSON object")
+
+            with SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) as body:
+                shutil.copyfileobj(request.stream, body)
+
+                # Validate, checking the nesting depth before anything builds prefixes
+                doc_count = 0
+                try:
+                    body.seek(0)
+                    _check_json_depth(body)
+
+                    body.seek(0)
+                    for i, doc in enumerate(_iter_json_array(body)):
+                        error_msg = validate_osquery_doc(i, doc)
+                        if error_msg:
+                            return api_error(error_msg)
+                        doc_count += 1
+                except ijson.JSONError:
+                    return api_error("Invalid JSON object")
+                except InvalidSubmission as e:
+                    return api_error(str(e))
+
+                if doc_count == 0:
+                    return api_error("Invalid JSON object")
+
+                body.seek(0)
+                return index_docs(_iter_json_array(body))
+
+        return index_docs(docs)
+
+    def index_docs(docs):
+        """
+        Tag validated osquery docs, index them, and send notifications about them
+        """
+        user = g.user
+
+        # All docs in this batch go to today's index
+        index = "flock-{}".format(datetime.now().strftime("%Y-%m-%d"))
+
+        # Count actions of the docs that trigger each notification, and keep the
+        # first one in case it's the only one
+        notification_counts = defaultdict(Counter)
+        notification_first_docs = {}
+        processed_count = 0
+
+        # Tag docs and prepare them for bulk indexing
+        def actions():
+            nonlocal processed_count
+            for doc in docs:
+                # Convert 'unixTime' to '@timestamp'
+                if "unixTime" in doc:
+                    doc["@timestamp"] = datetime.utcfromtimestamp(
+                        int(doc["unixTime"])
+                    ).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+                # Tag
+                doc["username"] = request.authorization["username"]
+                doc["user_name"] = user.name
+
+                # Figure out what notifications to send
+                name = doc.get("name")
+                if (
+                    isinstance(name, str)
+                    and name in keybase_notifications.osquery_names
+                ):
+                    action = doc.get("action")
+                    if action != "added" and action != "removed":
+                        action = "other"
+                    notification_counts[name][action] += 1
+                    notification_first_docs.setdefault(name, doc)
+
+                processed_count += 1
+                yield {"_index": index, "_type": "osquery", "_source": doc}
 
         # Add data to ElasticSearch
-        notification_docs = defaultdict(list)
-        for doc in docs:
-            # Convert 'unixTime' to '@timestamp'
-            if "unixTime" in doc:
-                doc["@timestamp"] = datetime.utcfromtimestamp(
-                    int(doc["unixTime"])
-                ).strftime("%Y-%m-%dT%H:%M:%S.000Z")
-
-            # Tag
-            doc["username"] = request.authorization["username"]
-            doc["user_name"] = user.name
-
-            # Add data
-            index = "flock-{}".format(datetime.now().strftime("%Y-%m-%d"))
-            es.index(index=index, doc_type="osquery", body=doc)
-
-        # Figure out what notifications to send
-        for doc in docs:
-            if "name" in doc and doc["name"] in notification_names:
-                notification_docs[doc["name"]].append(doc)
+        helpers.bulk(es, actions(), chunk_size=500, request_timeout=30)
 
         # Send notifications
-        for key, value in notification_docs.items():
-            if len(value) == 1:
-                keybase_notifications.add(key, value[0])
-            elif len(value) > 1:
-                added_count = 0
-                removed_count = 0
-                other_count = 0
-                for doc in value:
-                    if "action" in doc:
-                        if doc["action"] == "added":
-                            added_count += 1
-                        elif doc["action"] == "removed":
-                            removed_count += 1
-                        else:
-                            other_count += 1
-                    else:
-                        other_count += 1
-
+        for key, counts in notification_counts.items():
+            if sum(counts.values()) == 1:
+                keybase_notifications.add(key, notification_first_docs[key])
+            else:
                 keybase_notifications.add(
                     key,
                     {
                         "type": "summary",
                         "username": request.authorization["username"],
                         "name": user.name,
-                        "added_count": added_count,
-                        "removed_count": removed_count,
-                        "other_count": other_count,
+                        "added_count": counts["added"],
+                        "removed_count": counts["removed"],
+                        "other_count": counts["other"],
                     },
                 )
 
-        return api_success({"processed_count": len(docs)})
+        return api_success({"processed_count": processed_count})
 
     @app.route("/submit_flock_logs", methods=["POST"])
     @requires_auth
@@ -258,13 +381,13 @@ def create_api_app(test_config=None):
         except:
             return api_error("Invalid JSON object")
 
-        if type(docs) != list:
+        if not isinstance(docs, list):
             return api_error("Data is not an array")
 
         # Validate
         for i, doc in enumerate(docs):
             # Item should be an object
-            if type(doc) != dict:
+            if not isinstance(doc, dict):
                 return api_error("Item {} is not an object".format(i))
 
             # Item should have type and timestamp, and maybe twig_id
@@ -290,7 +413,7 @@ def create_api_app(test_config=None):
             ]:
                 details = {
                     "username": request.authorization["username"],
-                    "name": get_name(),
+                    "name": g.user.name,
                 }
                 if doc["type"] in ["twigs_enabled", "twigs_disabled"]:
                     details["twig_ids"] = doc["twig_ids"]
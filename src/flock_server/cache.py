@@ -0,0 +1,50 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A small in-process LRU cache where each entry also expires after its own TTL
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return default
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
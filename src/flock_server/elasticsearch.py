@@ -1,9 +1,24 @@
 import os
 from datetime import datetime
 
+import orjson
 from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import ConnectionError
-from elasticsearch_dsl import connections, Date, Document, Index, Text, Boolean
+from elasticsearch.exceptions import (
+    ConnectionError,
+    RequestError,
+    SerializationError,
+    TransportError,
+)
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch_dsl import (
+    connections,
+    Date,
+    Document,
+    Index,
+    Text,
+    Keyword,
+    Boolean,
+)
 
 
 # Configure ElasticSearch default connection
@@ -16,38 +31,76 @@ if "ELASTICSEARCH_HOSTS" in os.environ:
 else:
     elasticsearch_url = "https://elasticsearch:9200"
 
-# Connect using both high-level and low-level elasticsearch clients
+
+class ORJSONSerializer(JSONSerializer):
+    """
+    JSONSerializer that uses orjson, which is much faster than the standard library
+    """
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+
+        # The bulk helpers expect str, not bytes
+        try:
+            return orjson.dumps(
+                data, default=self.default, option=orjson.OPT_NON_STR_KEYS
+            ).decode()
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+
+# Connection pool size, should match the number of concurrent requests per worker
+if "ELASTICSEARCH_MAXSIZE" in os.environ:
+    elasticsearch_maxsize = int(os.environ["ELASTICSEARCH_MAXSIZE"])
+else:
+    elasticsearch_maxsize = 50
+
+# Create a single client, and share it with the high-level elasticsearch client
 if elasticsearch_url.startswith("https://"):
     if "ELASTIC_PASSWORD" in os.environ:
         http_auth = ("elastic", os.environ["ELASTIC_PASSWORD"])
     else:
         http_auth = None
 
-    connections.create_connection(
+    es = Elasticsearch(
         hosts=[elasticsearch_url],
         timeout=20,
+        maxsize=elasticsearch_maxsize,
+        http_compress=True,
+        serializer=ORJSONSerializer(),
         use_ssl=True,
         verify_certs=True,
         ca_certs=ca_cert_path,
         http_auth=http_auth,
     )
+else:
     es = Elasticsearch(
-        hosts=[elasticsearch_url],
+        [elasticsearch_url],
         timeout=20,
-        use_ssl=True,
-        verify_certs=True,
-        ca_certs=ca_cert_path,
-        http_auth=http_auth,
+        maxsize=elasticsearch_maxsize,
+        http_compress=True,
+        serializer=ORJSONSerializer(),
     )
-else:
-    connections.create_connection(hosts=[elasticsearch_url], timeout=20)
-    es = Elasticsearch([elasticsearch_url], timeout=20)
+
+connections.add_connection("default", es)
+
+
+# Users are stored in a versioned index, and looked up through the "user" alias
+user_index_version = "user_v2"
 
 
 class User(Document):
-    username = Text()
+    username = Keyword()
     name = Text()
-    token = Text()
+    token = Keyword()
     created_at = Date()
 
     class Index:
@@ -74,3 +127,43 @@ class KeybaseNotification(Document):
 
     class Index:
         name = "keybase_notification"
+
+
+def migrate_user_index():
+    """
+    Point the "user" alias at the current versioned user index, creating it if needed.
+
+    Older versions stored users directly in a "user" index, with username and token
+    mapped as analyzed text. Mappings can't be changed in place, so those users are
+    copied into the versioned index, and the old index is swapped for the alias in one
+    atomic step. The copy skips users that are already there, so if this gets
+    interrupted, running it again picks up where it left off.
+    """
+    if es.indices.exists_alias(name="user"):
+        return
+
+    try:
+        User._index.clone(name=user_index_version).create(using=es)
+    except RequestError as e:
+        if e.error != "resource_already_exists_exception":
+            raise
+
+    actions = [{"add": {"index": user_index_version, "alias": "user"}}]
+    if es.indices.exists(index="user"):
+        print("Migrating users to {}".format(user_index_version))
+        es.reindex(
+            body={
+                "conflicts": "proceed",
+                "source": {"index": "user"},
+                "dest": {"index": user_index_version, "op_type": "create"},
+            },
+            refresh=True,
+        )
+        actions.insert(0, {"remove_index": {"index": "user"}})
+
+    try:
+        es.indices.update_aliases(body={"actions": actions})
+    except TransportError:
+        # Fine if someone else swapped the alias in first
+        if not es.indices.exists_alias(name="user"):
+            raise
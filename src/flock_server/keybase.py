@@ -147,7 +147,7 @@ class Handler:
             return False
 
         # Get the user
-        results = User.search().query("match", username=username).execute()
+        results = User.search().filter("term", username=username).execute()
         if len(results) == 0:
             await self._send(
                 bot,
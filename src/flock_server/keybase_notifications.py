@@ -2,9 +2,14 @@ import json
 from datetime import datetime
 from elasticsearch_dsl import Index, Search
 
+from .cache import TTLCache
 from .elasticsearch import es, User, Setting, KeybaseNotification
 
 
+# How long to use notification settings before reloading them, in seconds
+SETTINGS_CACHE_TTL = 60
+
+
 class KeybaseNotifications:
     def __init__(self):
         self.notifications = {
@@ -58,6 +63,22 @@ class KeybaseNotifications:
         }
         self.warnings = ["reverse_shell"]
 
+        # Names of the notifications that are triggered by osquery docs
+        self.osquery_names = frozenset(
+            key
+            for key in self.notifications
+            if self.notifications[key]["type"] == "osquery"
+        )
+
+        # Notification settings, so they aren't loaded from elasticsearch every time
+        self._settings_cache = TTLCache()
+
+    def invalidate(self):
+        """
+        Forget the cached notification settings, so they're reloaded next time
+        """
+        self._settings_cache.clear()
+
     def _get_default_settings(self):
         default_settings = {}
         for notification in self.notifications:
@@ -84,6 +105,17 @@ class KeybaseNotifications:
         return setting
 
     def _load_settings(self):
+        notification_settings = self._settings_cache.get("settings")
+        if notification_settings is None:
+            notification_settings = self._fetch_settings()
+            self._settings_cache.set(
+                "settings", notification_settings, SETTINGS_CACHE_TTL
+            )
+
+        # Callers modify the settings they get back, so don't hand out the cached dict
+        return dict(notification_settings)
+
+    def _fetch_settings(self):
         setting = self._get_setting()
         try:
             notification_settings = json.loads(setting.value)
@@ -118,6 +150,9 @@ class KeybaseNotifications:
         setting.update(value=json.dumps(notification_settings))
         setting.save()
         Index("setting").refresh()
+        self._settings_cache.set(
+            "settings", dict(notification_settings), SETTINGS_CACHE_TTL
+        )
 
     def _is_enabled(self, notification):
         if notification not in self.notifications:
@@ -0,0 +1,9 @@
+# WSGI entrypoint, for running the API under gunicorn:
+#
+#   gunicorn "flock_server.wsgi:app" -k gevent
+#
+# gunicorn's gevent worker monkey patches the standard library before it imports
+# this module, so requests and elasticsearch sockets are cooperative.
+from .api import create_api_app
+
+app = create_api_app()
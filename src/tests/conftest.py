@@ -3,7 +3,13 @@ import json
 import pytest
 
 from elasticsearch_dsl import Index, Search
-from flock_server import create_api_app, KeybaseHandler, KeybaseNotifications, Setting
+from flock_server import (
+    create_api_app,
+    KeybaseHandler,
+    KeybaseNotifications,
+    Setting,
+    migrate_user_index,
+)
 
 
 class BotStub:
@@ -50,6 +56,9 @@ def client(app):
     """A test client for the app."""
     client = app.test_client()
 
+    # Make sure the user alias points at an index with keyword mappings
+    migrate_user_index()
+
     # Delete all users
     Search(index="user").query("match_all").delete()
     Index("user").refresh()
@@ -1,6 +1,8 @@
 import json
 import base64
 
+from elasticsearch_dsl import Index, Search
+
 
 def get_auth_header(client, username="UUID1"):
     res = client.post("/register", json={"username": username})
@@ -51,6 +53,17 @@ def test_register_cannot_register_existing_username(client):
     assert res.status_code == 400
 
 
+def test_register_similar_usernames(client):
+    res = client.post("/register", json={"username": "computer-1"})
+    assert res.status_code == 200
+
+    res = client.post("/register", json={"username": "computer-2"})
+    assert res.status_code == 200
+
+    res = client.post("/register", json={"username": "COMPUTER-1"})
+    assert res.status_code == 200
+
+
 def test_register_with_name(client):
     res = client.post("/register", json={"username": "UUID1", "name": "Nick Fury"})
     assert res.status_code == 200
@@ -150,3 +163,91 @@ def test_submit_list(client):
     )
     assert res.status_code == 200
     assert json.loads(res.data)["processed_count"] == 3
+
+
+def test_ping_cached_auth(client, monkeypatch):
+    auth_header = get_auth_header(client)
+
+    # Count searches from here on
+    searches = []
+    execute = Search.execute
+
+    def counting_execute(self, *args, **kwargs):
+        searches.append(self.to_dict())
+        return execute(self, *args, **kwargs)
+
+    monkeypatch.setattr(Search, "execute", counting_execute)
+
+    for _ in range(3):
+        assert client.get("/ping", headers=auth_header).status_code == 200
+    assert len(searches) == 1
+
+    # A bad token for the same username is still rejected
+    encoded_credentials = base64.b64encode(b"UUID1:bad_token").decode()
+    res = client.get("/ping", headers={"Authorization": f"Basic {encoded_credentials}"})
+    assert res.status_code == 401
+
+
+def test_register_forgets_cached_auth(client):
+    old_auth_header = get_auth_header(client)
+    assert client.get("/ping", headers=old_auth_header).status_code == 200
+
+    # Delete the user behind the server's back, and register the username again
+    Search(index="user").query("match_all").delete()
+    Index("user").refresh()
+    new_auth_header = get_auth_header(client)
+
+    assert client.get("/ping", headers=old_auth_header).status_code == 401
+    assert client.get("/ping", headers=new_auth_header).status_code == 200
+
+
+def test_submit_large_list(client):
+    username = "UUID5555"
+    auth_header = get_auth_header(client, username)
+
+    # Big enough to be streamed rather than parsed all at once
+    padding = "x" * 100
+    docs = [{"hostIdentifier": username, "padding": padding} for _ in range(1000)]
+
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 200
+    assert json.loads(res.data)["processed_count"] == 1000
+
+    # An invalid log object anywhere in the stream is rejected
+    docs[700] = {"hostIdentifier": "invalid_username", "padding": padding}
+    res = client.post("/submit", json=docs, headers=auth_header)
+    assert res.status_code == 400
+
+    # So is a large log object that isn't in a list
+    res = client.post(
+        "/submit",
+        json={"hostIdentifier": username, "padding": padding * 1000},
+        headers=auth_header,
+    )
+    assert res.status_code == 400
+
+    # And so is deeply nested JSON
+    res = client.post(
+        "/submit",
+        data="[" * (64 * 1024),
+        content_type="application/json",
+        headers=auth_header,
+    )
+    assert res.status_code == 400
+
+
+def test_submit_invalid_list_indexes_nothing(client):
+    username = "UUID6666"
+    auth_header = get_auth_header(client, username)
+
+    # Both small batches and ones big enough to be streamed are all or nothing
+    padding = "x" * 100
+    for count in [3, 1000]:
+        docs = [{"hostIdentifier": username, "padding": padding} for _ in range(count)]
+        docs[-2] = {"hostIdentifier": "invalid_username"}
+
+        res = client.post("/submit", json=docs, headers=auth_header)
+        assert res.status_code == 400
+
+    Index("flock-*").refresh()
+    assert Search(index="flock-*").query("match", username=username).count() == 0
@@ -244,3 +244,19 @@ async def test_disable_notification(keybase_notifications, handler, bot):
     await handler.__call__(bot, event)
     assert bot.said(":x: **user_registered**")
     assert bot.said(":white_check_mark: **user_already_exists**")
+
+
+@pytest.mark.asyncio
+async def test_notification_settings_invalidate(keybase_notifications, handler, bot):
+    assert keybase_notifications.get_enabled_state()["user_registered"]
+
+    event = create_event(
+        "kbusername1", "@flockbot disable_notification user_registered"
+    )
+    await handler.__call__(bot, event)
+    assert bot.said("Notification disabled")
+
+    # Settings are cached until they're invalidated
+    assert keybase_notifications.get_enabled_state()["user_registered"]
+    keybase_notifications.invalidate()
+    assert not keybase_notifications.get_enabled_state()["user_registered"]